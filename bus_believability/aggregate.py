@@ -1,6 +1,6 @@
-import pprint
 import collections
 from dataclasses import dataclass
+from blocks_to_transfers.service_days import ServiceDays
 
 @dataclass(frozen=True)
 class ItineraryIndex:
@@ -45,3 +45,45 @@ def get_stop_index(gtfs, itineraries):
 
     return stop_index
 
+
+class ServiceIndex:
+    # Built once per feed. Trips are sorted once, and each service is a bitset
+    # over that order, so the trips for any date are a union of bitsets.
+    def __init__(self, gtfs):
+        self.service_days = ServiceDays(gtfs)
+        self.trips = sorted(gtfs.trips.values(), key=lambda trip: trip.first_departure)
+
+        bits_by_service = {}
+        for i, trip in enumerate(self.trips):
+            bits = bits_by_service.setdefault(trip.service_id, bytearray(len(self.trips) // 8 + 1))
+            bits[i // 8] |= 1 << (i % 8)
+
+        self.trips_by_service = {service_id: int.from_bytes(bits, 'little')
+                                 for service_id, bits in bits_by_service.items()}
+        self._trips_by_date = {}
+
+    def active_services(self, service_date):
+        day = (service_date - self.service_days.epoch).days
+        return {service_id for service_id, days
+                in self.service_days.days_by_service.items() if 0 <= day < len(days) and days[day]}
+
+    def active_mask(self, service_date):
+        mask = 0
+        for service_id in self.active_services(service_date):
+            mask |= self.trips_by_service.get(service_id, 0)
+
+        return mask
+
+    def active_trips(self, service_date):
+        if service_date not in self._trips_by_date:
+            mask = self.active_mask(service_date)
+            trips = []
+            for byte_ofs, byte in enumerate(mask.to_bytes(len(self.trips) // 8 + 1, 'little')):
+                while byte:
+                    low = byte & -byte
+                    trips.append(self.trips[byte_ofs * 8 + low.bit_length() - 1])
+                    byte ^= low
+
+            self._trips_by_date[service_date] = trips
+
+        return self._trips_by_date[service_date]
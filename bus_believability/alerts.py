@@ -2,6 +2,7 @@ import argparse
 import re
 import datetime
 import sqlite3
+import contextlib
 from .schema import Alert, NamedEntities, OrdinalSeries, NamedDate, NamedTime, Meridiem, RecognizedAlert
 
 NOW = datetime.datetime.now()
@@ -86,14 +87,15 @@ def expand_datetime(entities):
             yield datetime.datetime.combine(date, time)
 
 def recognize_alerts(db_file):
-    con = sqlite3.connect(db_file)
-    con.row_factory = Alert.fromsql
-    alerts = []
-    for row in con.execute('SELECT * FROM alerts;'):
-        alerts.append(RecognizedAlert(
-            alert=row,
-            dt=list(expand_datetime(fake_ner(row.title)))
-        ))
+    # Called on a timer by the prediction server, so don't leave the connection to the GC
+    with contextlib.closing(sqlite3.connect(db_file)) as con:
+        con.row_factory = Alert.fromsql
+        alerts = []
+        for row in con.execute('SELECT * FROM alerts;'):
+            alerts.append(RecognizedAlert(
+                alert=row,
+                dt=list(expand_datetime(fake_ner(row.title)))
+            ))
 
     return alerts
 
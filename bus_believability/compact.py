@@ -0,0 +1,98 @@
+#!/usr/bin/env pypy3
+import sqlite3
+import argparse
+import time
+import math
+from pathlib import Path
+
+LIVE_HORIZON = 600 # Leave the last 10 minutes of a live day alone
+STATIONARY_RADIUS = 30 # metres; GPS jitter of a parked bus stays within this
+EARTH_RADIUS = 6371000 # metres
+
+# The tracker upserts on position, so GPS jitter makes a new row every poll.
+# Per trip, stop and vehicle, keep the first and last sighting; drop the first
+# as well if the vehicle stayed within STATIONARY_RADIUS of it. Exact positions
+# can't be compared: the unique key means no two rows in a run share one.
+COMPACT_QUERY = """
+DELETE FROM vehicle_updates
+WHERE observed_at < ?
+AND rowid NOT IN (
+    SELECT rowid FROM (
+        SELECT rowid, lat, lon,
+            ROW_NUMBER() OVER (run ORDER BY observed_at, rowid) AS first_rank,
+            ROW_NUMBER() OVER (run ORDER BY observed_at DESC, rowid DESC) AS last_rank,
+            FIRST_VALUE(lat) OVER (run ORDER BY observed_at DESC, rowid DESC) AS last_lat,
+            FIRST_VALUE(lon) OVER (run ORDER BY observed_at DESC, rowid DESC) AS last_lon
+        FROM vehicle_updates
+        WINDOW run AS (PARTITION BY start_date, trip_id, stop_sequence, vehicle_id)
+    )
+    WHERE last_rank = 1
+    OR (first_rank = 1 AND distance(lat, lon, last_lat, last_lon) > ?)
+);
+"""
+
+
+def main():
+    cmd = argparse.ArgumentParser(description='Collapse vehicle_updates to first/last sightings per trip and stop')
+    cmd.add_argument('db', help='Day database files to compact', type=Path, nargs='+')
+    cmd.add_argument('--live', help='The day is still being tracked: only compact older rows and skip VACUUM', action='store_true')
+    args = cmd.parse_args()
+
+    for db_file in args.db:
+        compact_db(db_file, live=args.live)
+
+
+def distance(lat1, lon1, lat2, lon2):
+    # Equirectangular approximation, which is plenty at tens of metres
+    if None in (lat1, lon1, lat2, lon2):
+        return math.inf
+
+    x = math.radians(lon2 - lon1) * math.cos(math.radians((lat1 + lat2) / 2))
+    y = math.radians(lat2 - lat1)
+    return EARTH_RADIUS * math.hypot(x, y)
+
+
+def compact_db(db_file, live=False):
+    con = sqlite3.connect(db_file)
+    con.create_function('distance', 4, distance, deterministic=True)
+    rows_before = count_rows(con)
+    size_before = db_file.stat().st_size
+    scan_before = time_scan(con)
+
+    cutoff = int(time.time()) - LIVE_HORIZON if live else math.inf
+    with con:
+        con.execute(COMPACT_QUERY, (cutoff, STATIONARY_RADIUS))
+
+    # VACUUM rewrites the whole file under an exclusive lock, which would stall the tracker
+    if not live:
+        con.execute('VACUUM;')
+
+    rows_after = count_rows(con)
+    size_after = db_file.stat().st_size
+    scan_after = time_scan(con)
+    con.close()
+
+    print(f'Compacted {db_file}: {rows_before} -> {rows_after} rows, '
+          f'{size_before // 1024} -> {size_after // 1024} KiB, '
+          f'scan {scan_before * 1000:.1f} -> {scan_after * 1000:.1f} ms '
+          f'({scan_before / max(scan_after, 1e-9):.1f}x)')
+
+
+def count_rows(con):
+    return con.execute('SELECT COUNT(*) FROM vehicle_updates;').fetchone()[0]
+
+
+def time_scan(con, repeat=3):
+    # Same access pattern as Predictor.fetch_observations
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        con.execute('SELECT * FROM vehicle_updates ORDER BY observed_at;').fetchall()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,175 @@
+#!/usr/bin/env pypy3
+import argparse
+import datetime
+import json
+import random
+import threading
+import time
+from dataclasses import dataclass
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from .track import gtfs_realtime_pb2 as rt
+
+VEHICLES_PATH = '/gtfs-realtime/vehicleupdates.pb'
+ALERTS_PATH = '/alerts'
+
+
+@dataclass
+class Faults:
+    latency: float = 0 # seconds before responding
+    latency_jitter: float = 0 # up to this many extra seconds
+    growth: int = 0 # vehicles added per snapshot
+    max_vehicles: int = 5000
+    duplicate_rate: float = 0 # serve the previous snapshot again
+    malformed_rate: float = 0 # truncated protobuf
+    error_rate: float = 0 # HTTP 503
+
+
+def add_fault_arguments(cmd):
+    cmd.add_argument('--vehicles', help='Vehicles in the first snapshot', type=int, default=100)
+    cmd.add_argument('--latency', help='Wall clock seconds to wait before responding, whatever the soak speedup', type=float, default=0)
+    cmd.add_argument('--latency-jitter', help='Up to this many extra seconds of latency', type=float, default=0)
+    cmd.add_argument('--growth', help='Vehicles added to each snapshot', type=int, default=0)
+    cmd.add_argument('--max-vehicles', type=int, default=5000)
+    cmd.add_argument('--duplicate-rate', help='Fraction of polls served the previous snapshot', type=float, default=0)
+    cmd.add_argument('--malformed-rate', help='Fraction of polls served truncated protobuf', type=float, default=0)
+    cmd.add_argument('--error-rate', help='Fraction of polls answered with HTTP 503', type=float, default=0)
+    cmd.add_argument('--seed', type=int, default=0)
+
+
+def faults_from_args(args):
+    return Faults(
+        latency=args.latency,
+        latency_jitter=args.latency_jitter,
+        growth=args.growth,
+        max_vehicles=args.max_vehicles,
+        duplicate_rate=args.duplicate_rate,
+        malformed_rate=args.malformed_rate,
+        error_rate=args.error_rate,
+    )
+
+
+def main():
+    cmd = argparse.ArgumentParser(description='Serve synthetic GTFS-RT vehicle positions and alerts, with injected faults')
+    cmd.add_argument('--host', default='127.0.0.1')
+    cmd.add_argument('--port', type=int, default=8080)
+    add_fault_arguments(cmd)
+    args = cmd.parse_args()
+
+    feed = MockFeed(args.vehicles, faults_from_args(args), args.seed)
+    server = feed.serve(args.host, args.port)
+    print(f'Serving http://{args.host}:{args.port}{VEHICLES_PATH} and {ALERTS_PATH}')
+    server.serve_forever()
+
+
+class MockFeed:
+    def __init__(self, n_vehicles, faults, seed=0):
+        self.faults = faults
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.vehicles = [self.new_vehicle(i) for i in range(n_vehicles)]
+        self.snapshot = None
+
+        # When the snapshot being served was generated, for measuring end-to-end lag
+        self.generated_at = None
+        self.requests = 0
+
+    def new_vehicle(self, i):
+        return dict(
+            vehicle_id=str(1000 + i),
+            trip_id=f'mock-{i}',
+            route_id=str(i % 50),
+            direction_id=i % 2,
+            lat=48.4 + self.random.random() * 0.1,
+            lon=-123.4 + self.random.random() * 0.1,
+            stop_sequence=1,
+        )
+
+    def next_snapshot(self):
+        with self.lock:
+            self.requests += 1
+            if self.snapshot and self.random.random() < self.faults.duplicate_rate:
+                return self.snapshot
+
+            for _ in range(min(self.faults.growth, self.faults.max_vehicles - len(self.vehicles))):
+                self.vehicles.append(self.new_vehicle(len(self.vehicles)))
+
+            self.generated_at = time.monotonic()
+            self.snapshot = self.encode_vehicles()
+            return self.snapshot
+
+    def encode_vehicles(self):
+        vp = rt.FeedMessage()
+        vp.header.gtfs_realtime_version = '2.0'
+        vp.header.timestamp = int(time.time())
+        start_date = datetime.date.today().strftime('%Y%m%d')
+        for vehicle in self.vehicles:
+            # Move along the route, with GPS jitter in between
+            if self.random.random() < 0.2:
+                vehicle['stop_sequence'] += 1
+            vehicle['lat'] += (self.random.random() - 0.5) * 1e-4
+            vehicle['lon'] += (self.random.random() - 0.5) * 1e-4
+
+            entity = vp.entity.add()
+            entity.id = vehicle['vehicle_id']
+            entity.vehicle.trip.trip_id = vehicle['trip_id']
+            entity.vehicle.trip.start_date = start_date
+            entity.vehicle.trip.route_id = vehicle['route_id']
+            entity.vehicle.trip.direction_id = vehicle['direction_id']
+            entity.vehicle.position.latitude = vehicle['lat']
+            entity.vehicle.position.longitude = vehicle['lon']
+            entity.vehicle.position.speed = self.random.random() * 15
+            entity.vehicle.current_stop_sequence = vehicle['stop_sequence']
+            entity.vehicle.stop_id = str(vehicle['stop_sequence'])
+            entity.vehicle.vehicle.id = vehicle['vehicle_id']
+            entity.vehicle.current_status = self.random.choice([0, 1, 2])
+
+        return vp.SerializeToString()
+
+    def alerts(self):
+        start_date = datetime.datetime.now().strftime('%B %d, %Y %I:%M %p')
+        return [dict(
+            id=i,
+            Routes=[str(i % 50)],
+            AlertStatus='Active',
+            StartDateFormatted=start_date,
+            Title=f'Route {i % 50} trip at {1 + i % 12}:{i % 60:02d} pm is cancelled',
+        ) for i in range(len(self.vehicles) // 20)]
+
+    def serve(self, host, port):
+        feed = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                faults = feed.faults
+                time.sleep(faults.latency + feed.random.random() * faults.latency_jitter)
+
+                if feed.random.random() < faults.error_rate:
+                    self.send_error(503)
+                elif self.path.startswith(VEHICLES_PATH):
+                    body = feed.next_snapshot()
+                    if feed.random.random() < faults.malformed_rate:
+                        body = body[:len(body) // 2]
+                    self.send_body(body, 'application/x-protobuf')
+                elif self.path.startswith(ALERTS_PATH):
+                    self.send_body(json.dumps(feed.alerts()).encode(), 'application/json')
+                else:
+                    self.send_error(404)
+
+            def send_body(self, body, content_type):
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                # One line per poll would drown out the soak report
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        return server
+
+
+if __name__ == '__main__':
+    main()
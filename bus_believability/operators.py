@@ -0,0 +1,76 @@
+import json
+import argparse
+from dataclasses import dataclass
+from typing import Optional
+
+VEHICLE_UPDATES_URL = 'https://bct.tmix.se/gtfs-realtime/vehicleupdates.pb?operatorIds={operator_id}'
+GTFS_URL = 'https://bct.tmix.se/Tmix.Cap.TdExport.WebApi/gtfs/?operatorIds={operator_id}'
+ALERT_URL = 'https://www.bctransit.com/sites/REST/controller/ServiceAlert/get-alert-list?micrositeid={microsite_id}&timezone=Canada/Pacific'
+
+
+@dataclass(frozen=True)
+class Operator:
+    # Tmix operator ID, used for the GTFS and GTFS-RT feeds
+    operator_id: str
+
+    # Names the storage partition for this operator
+    name: str
+
+    # bctransit.com microsite, used for service alerts
+    microsite_id: Optional[str] = None
+
+    # Subdirectory of the data, archive and GTFS locations; defaults to the name.
+    # "" keeps the operator at the top level, where single-operator deployments store it
+    partition: Optional[str] = None
+
+    @property
+    def prefix(self):
+        partition = self.name if self.partition is None else self.partition
+        return f'{partition}/' if partition else ''
+
+    @property
+    def vehicle_updates_url(self):
+        return VEHICLE_UPDATES_URL.format(operator_id=self.operator_id)
+
+    @property
+    def gtfs_url(self):
+        return GTFS_URL.format(operator_id=self.operator_id)
+
+    @property
+    def alert_url(self):
+        return ALERT_URL.format(microsite_id=self.microsite_id) if self.microsite_id else None
+
+
+VICTORIA = Operator(operator_id='20', name='victoria', microsite_id='1520526315921', partition='')
+
+
+def load_operators(config_path):
+    with open(config_path) as fp:
+        config = json.load(fp)
+
+    operators = [Operator(**operator) for operator in config['operators']]
+    if not operators:
+        raise ValueError(f'{config_path} lists no operators')
+
+    names = [operator.name for operator in operators]
+    if len(set(names)) != len(names):
+        raise ValueError(f'Operator names must be unique: {names}')
+
+    prefixes = [operator.prefix for operator in operators]
+    if len(set(prefixes)) != len(prefixes):
+        raise ValueError(f'Operator partitions must be unique: {prefixes}')
+
+    return operators
+
+
+def main():
+    # Used by get_static.sh, which can't parse JSON by itself
+    cmd = argparse.ArgumentParser(description='List the operators in a config file')
+    cmd.add_argument('config', help='JSON file listing operators')
+    args = cmd.parse_args()
+    for operator in load_operators(args.config):
+        print(operator.name, operator.gtfs_url, operator.prefix)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,16 +3,18 @@ import sqlite3
 import gtfs_loader
 import argparse
 import datetime
-import math
 import json
-from .schema import *
+import sys
+import time
+import resource
+from pathlib import Path
+from .schema import VehicleState, TripPrediction
 from . import aggregate
 from . import alerts
+from .operators import load_operators
 from typing import Optional
 from dataclasses import dataclass
 from functools import cached_property
-from blocks_to_transfers.service_days import ServiceDays
-import pprint
 
 MISSING_THRESHOLD = 360 # Mark as missing if more than 6 minutes late
 VEHICLE_STATUS_STR = ["INCOMING_AT", "STOPPED_AT", "IN_TRANSIT_TO"]
@@ -21,15 +23,39 @@ def main():
     today = datetime.datetime.now().strftime('%Y%m%d')
 
     cmd = argparse.ArgumentParser(description='Predict likelihood of a trip running based on RT data')
-    cmd.add_argument('--gtfs', help='Directory containing GTFS static feed', required=True)
-    cmd.add_argument('--db', help='A SQLite database containing GTFS-RT observations', required=True)
-    cmd.add_argument('--alerts', help='A SQLite database containing BCTransit-proprietary alerts', required=True)
+    cmd.add_argument('--gtfs', help='Directory containing GTFS static feed (with --config, one partition per operator)', required=True)
+    cmd.add_argument('--db', help='A SQLite database containing GTFS-RT observations')
+    cmd.add_argument('--alerts', help='A SQLite database containing BCTransit-proprietary alerts')
+    cmd.add_argument('--db-dir', help='With --config, the directory the vehicle tracker writes to (its --dir)', type=Path)
+    cmd.add_argument('--alerts-dir', help='With --config, the directory the alerts tracker writes to (its --dir)', type=Path)
     cmd.add_argument('--date', help='Service date in yyyymmdd format', default=today)
+    cmd.add_argument('--workers', help='Number of processes to shard blocks across', type=int, default=1)
+    cmd.add_argument('--config', help='JSON file listing operators to predict for')
 
     args = cmd.parse_args()
-    predictor = Predictor(args.gtfs, args.db, args.alerts, datetime.datetime.strptime(args.date, '%Y%m%d'))
-    predictor.update() 
-    print(json.dumps(predictor.get_all_blocks(), indent=2))
+    if args.config and not (args.db_dir and args.alerts_dir):
+        cmd.error('--db-dir and --alerts-dir are required with --config')
+    elif not args.config and not (args.db and args.alerts):
+        cmd.error('--db and --alerts are required without --config')
+
+    service_date = datetime.datetime.strptime(args.date, '%Y%m%d')
+
+    def make_predictor(gtfs_path, db_path, alerts_db_path):
+        if args.workers > 1:
+            from .shard import ShardedPredictor
+            return ShardedPredictor(gtfs_path, db_path, alerts_db_path, service_date, workers=args.workers)
+        return Predictor(gtfs_path, db_path, alerts_db_path, service_date)
+
+    if args.config:
+        predictor = OperatorPredictors(load_operators(args.config), make_predictor,
+                                       Path(args.gtfs), args.db_dir, args.alerts_dir, service_date)
+    else:
+        predictor = make_predictor(args.gtfs, args.db, args.alerts)
+    try:
+        predictor.update() 
+        print(json.dumps(predictor.get_all_blocks(), indent=2))
+    finally:
+        predictor.close()
     #print(json.dumps(predictor.get_departures('20', '1', '160376'), indent=2))
 
 class Predictor:
@@ -38,29 +64,51 @@ class Predictor:
         self.gtfs = gtfs_loader.load(gtfs_path)
         self.itineraries = aggregate.get_itineraries(self.gtfs)
         self.stop_index = aggregate.get_stop_index(self.gtfs, self.itineraries)
-        self.alerts = alerts.recognize_alerts(alerts_db_path)
-        self.cancelled_trips = alerts.link_alerts(self.trips_by_route, self.service_date, self.alerts)
-        self.con = sqlite3.connect(db_path)
-        self.con.row_factory = VehicleState.fromsql
+        self.service_index = aggregate.ServiceIndex(self.gtfs)
+        self.alerts_db_path = alerts_db_path
+        self.reload_alerts()
+        self.con = None
+        if db_path:
+            self.connect(db_path)
         print(self.cancelled_trips)
         self.results = {}
+        self.transitions = []
+
+    def connect(self, db_path):
+        if self.con:
+            self.con.close()
+
+        self.db_path = db_path
+        self.con = sqlite3.connect(db_path)
+        self.con.row_factory = VehicleState.fromsql
+
+    def close(self):
+        if self.con:
+            self.con.close()
+            self.con = None
 
     @cached_property
     def active_services(self):
-        service_days = ServiceDays(self.gtfs)
-        today_index = (self.service_date - service_days.epoch).days
-        return {service_id for service_id, days 
-                in service_days.days_by_service.items() if days[today_index]}
+        return self.service_index.active_services(self.service_date)
 
     @cached_property
     def active_trips(self):
-        active_trips = []
-        for trip in sorted(self.gtfs.trips.values(), key=lambda trip: trip.first_departure):
-            if trip.service_id in self.active_services:
-                active_trips.append(trip)
+        return self.service_index.active_trips(self.service_date)
+
+    def set_service_date(self, service_date):
+        # Reuses the per-feed indexes; only what depends on the date is rebuilt
+        self.service_date = service_date
+        for name in ('active_services', 'active_trips', 'trips_by_block', 'trip_blocks', 'trips_by_route'):
+            self.__dict__.pop(name, None)
 
-        return active_trips
+        self.reload_alerts()
+        self.results.clear()
 
+    def reload_alerts(self):
+        # The alerts tracker keeps adding cancellations, so re-read them rather than relying on startup's.
+        # Operators without a bctransit.com microsite have no alerts database at all.
+        self.alerts = alerts.recognize_alerts(self.alerts_db_path) if self.alerts_db_path else []
+        self.cancelled_trips = alerts.link_alerts(self.trips_by_route, self.service_date, self.alerts)
 
     @cached_property
     def trips_by_block(self):
@@ -70,6 +118,10 @@ class Predictor:
 
         return trips_by_block
 
+    @cached_property
+    def trip_blocks(self):
+        return {trip.trip_id: trip.block_id for trip in self.active_trips}
+
 
     @cached_property
     def trips_by_route(self):
@@ -83,28 +135,55 @@ class Predictor:
     def fetch_observations(self):
         cur = self.con.cursor()
         trip_observations = {}
-        query = 'SELECT * from vehicle_updates WHERE start_date = ?;'
+        # Several rows per stop once the vehicle moves; the latest sighting wins
+        query = 'SELECT * from vehicle_updates WHERE start_date = ? ORDER BY observed_at;'
         for row in cur.execute(query, (self.service_date.strftime('%Y%m%d'),)):
             trip_observations.setdefault(row.trip_id, {})[row.stop_sequence] = row
 
         return trip_observations
 
-    def update(self):
-        trip_observations = self.fetch_observations()
-        now = datetime.datetime.now()
-        self.results.clear()
-
-        for block_id, trips in self.trips_by_block.items():
-            block_status = TripPrediction.SCHEDULED
-            for trip in trips:
+    def update(self, now=None):
+        self.predict(self.fetch_observations(), now or datetime.datetime.now())
+
+    def predict(self, trip_observations, now):
+        self.set_results(self.predict_blocks(self.trips_by_block, trip_observations, now), now)
+
+    def set_results(self, results, now):
+        # The first results after starting or switching dates only seed what later ones are diffed against
+        self.transitions = get_transitions(self.results, results, now) if self.results else []
+        self.results = results
+
+    def update_trips(self, changed_trips, trip_observations, now):
+        # For callers that know which trips have new observations or passed a status
+        # threshold; the rest keep their results unless the block status they follow changed
+        block_ids = {self.trip_blocks[trip_id] for trip_id in changed_trips}
+        results = self.predict_blocks(block_ids, trip_observations, now, changed_trips)
+        self.transitions = get_transitions(self.results, results, now)
+        self.results.update(results)
+
+    def predict_blocks(self, block_ids, trip_observations, now, changed_trips=None):
+        results = {}
+        for block_id in block_ids:
+            block_status = previous_block_status = TripPrediction.SCHEDULED
+            for trip in self.trips_by_block[block_id]:
+                previous = self.results.get(trip.trip_id)
+                if (changed_trips is not None and previous and block_status == previous_block_status
+                        and trip.trip_id not in changed_trips):
+                    block_status = previous_block_status = previous['block_status']
+                    continue
+
+                previous_block_status = previous and previous['block_status']
                 observations = trip_observations.get(trip.trip_id, {})
                 latest_event = (max(observations.values(), key=lambda event: event.stop_sequence) 
                                 if observations else None)
                 trip_predictor = TripPredictor(trip, self.service_date, latest_event,
                                                is_cancelled=trip.trip_id in self.cancelled_trips)
 
-                block_status = self._predict_from_previous_trips(block_status, trip_predictor.status(now))
-                self.results[trip.trip_id] = trip_predictor.get_trip_desc(now, block_status) 
+                live_status = trip_predictor.status(now)
+                block_status = self._predict_from_previous_trips(block_status, live_status)
+                results[trip.trip_id] = trip_predictor.get_trip_desc(now, block_status, live_status)
+
+        return results
 
     def get_all_blocks(self):
         all_results = {}
@@ -144,6 +223,61 @@ class Predictor:
         else:
             return block_status
 
+def get_transitions(previous, results, now):
+    # Only the status changes since the last update, so consumers don't have to diff full dumps
+    transitions = []
+    for trip_id, result in results.items():
+        before = previous.get(trip_id) or {}
+        if (before.get('live_status') == result['live_status']
+                and before.get('block_status') == result['block_status']):
+            continue
+
+        transitions.append(dict(
+            at=now.strftime('%Y-%m-%d %H:%M:%S'),
+            trip_id=trip_id,
+            block_id=result['block_id'],
+            route_short_name=result['route_short_name'],
+            live_status=result['live_status'],
+            block_status=result['block_status'],
+            previous_live_status=before.get('live_status'),
+            previous_block_status=before.get('block_status'),
+        ))
+
+    return transitions
+
+
+class OperatorPredictors:
+    # Serves several feeds from one process, laid out the way the trackers write them with --config
+    def __init__(self, operators, make_predictor, gtfs_dir, db_dir, alerts_dir, service_date):
+        self.predictors = {}
+        for operator in operators:
+            started = time.perf_counter()
+            self.predictors[operator.name] = make_predictor(
+                    gtfs_dir / operator.prefix,
+                    db_dir / operator.prefix / f"{service_date.strftime('%Y%m%d')}.db",
+                    alerts_dir / operator.prefix / 'alerts.db' if operator.alert_url else None)
+            max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024
+            print(f'Loaded {operator.name} in {time.perf_counter() - started:.2f}s (max RSS {max_rss} MiB)', file=sys.stderr)
+
+    def update(self, now=None):
+        now = now or datetime.datetime.now()
+        started = time.perf_counter()
+        n_trips = 0
+        for predictor in self.predictors.values():
+            predictor.update(now)
+            n_trips += len(predictor.results)
+
+        elapsed = time.perf_counter() - started
+        print(f'Predicted {n_trips} trips across {len(self.predictors)} operators in {elapsed:.2f}s', file=sys.stderr)
+
+    def get_all_blocks(self):
+        return {name: predictor.get_all_blocks() for name, predictor in self.predictors.items()}
+
+    def close(self):
+        for predictor in self.predictors.values():
+            predictor.close()
+
+
 @dataclass
 class TripPredictor:
     trip: any
@@ -162,6 +296,16 @@ class TripPredictor:
     def status(self, now):
         return self.live_status(now) if self.latest_event else self.scheduled_status(now)
 
+    def status_changes_at(self):
+        # Besides new observations, status(now) can only change at these times
+        if self.latest_event:
+            # ARRIVED once strictly past live_end
+            return [self.live_end + datetime.timedelta(microseconds=1)]
+
+        return [self.scheduled_start,
+                self.scheduled_start + datetime.timedelta(seconds=MISSING_THRESHOLD),
+                self.scheduled_end]
+
     def scheduled_status(self, now):
         if self.is_cancelled:
             return TripPrediction.CANCELLED
@@ -206,9 +350,9 @@ class TripPredictor:
                 vehicle_id=self.latest_event.vehicle_id
         )
 
-    def get_trip_desc(self, now, block_status):
+    def get_trip_desc(self, now, block_status, live_status=None):
         return dict(
-                    live_status=self.status(now),
+                    live_status=live_status or self.status(now),
                     block_status=block_status,
                     route_short_name=self.trip.route.route_short_name,
                     trip_headsign=self.trip.trip_headsign,
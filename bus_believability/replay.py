@@ -0,0 +1,165 @@
+#!/usr/bin/env pypy3
+import sqlite3
+import argparse
+import datetime
+import time
+import json
+import heapq
+from pathlib import Path
+from .schema import VehicleState
+from .predict import Predictor, TripPredictor, MISSING_THRESHOLD
+from .track import gtfs_realtime_pb2 as rt
+from .track.vehicles import parse_vehicle_positions
+
+STEP = 20 # Same cadence as the vehicle tracker
+
+
+def main():
+    cmd = argparse.ArgumentParser(description='Replay recorded GTFS-RT observations through the predictor')
+    cmd.add_argument('--gtfs', help='Directory containing GTFS static feed', required=True)
+    cmd.add_argument('--alerts', help='A SQLite database containing BCTransit-proprietary alerts', required=True)
+    cmd.add_argument('--date', help='Service date in yyyymmdd format', required=True)
+    source = cmd.add_mutually_exclusive_group(required=True)
+    source.add_argument('--db', help='A SQLite database containing GTFS-RT observations')
+    source.add_argument('--snapshots', help='Directory of captured vehicle position protobufs (<unix time>.pb)', type=Path)
+    cmd.add_argument('--step', help='Seconds of simulated time between predictions', type=int, default=STEP)
+    cmd.add_argument('--speedup', help='Simulated seconds per wall clock second (default: as fast as possible)', type=float)
+    cmd.add_argument('--output', help='Write the prediction timeline as JSON to this file', type=Path)
+
+    args = cmd.parse_args()
+    service_date = datetime.datetime.strptime(args.date, '%Y%m%d')
+    if args.db:
+        observations = load_db_observations(args.db, service_date)
+    else:
+        observations = load_snapshot_observations(args.snapshots, service_date)
+
+    predictor = Predictor(args.gtfs, None, args.alerts, service_date)
+    replay = Replay(predictor, observations, args.step, args.speedup)
+    started = time.perf_counter()
+    replay.run()
+    elapsed = time.perf_counter() - started
+    print(f'Replayed {replay.ticks} ticks ({len(observations)} observations, '
+          f'{len(replay.timeline)} trips) in {elapsed:.2f}s')
+
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(dict(
+                service_date=args.date,
+                step=args.step,
+                ticks=replay.ticks,
+                elapsed=elapsed,
+                timeline=replay.timeline,
+            ), fp, indent=2)
+
+
+def load_db_observations(db_path, service_date):
+    con = sqlite3.connect(db_path)
+    con.row_factory = VehicleState.fromsql
+    query = 'SELECT * FROM vehicle_updates WHERE start_date = ? ORDER BY observed_at;'
+    return con.execute(query, (service_date.strftime('%Y%m%d'),)).fetchall()
+
+
+def load_snapshot_observations(snapshot_dir, service_date):
+    start_date = int(service_date.strftime('%Y%m%d'))
+    observations = []
+    for path in sorted(snapshot_dir.glob('*.pb')):
+        vp = rt.FeedMessage()
+        vp.ParseFromString(path.read_bytes())
+        observed_at = vp.header.timestamp or int(path.stem)
+        observations.extend(vs for vs in parse_vehicle_positions(vp, observed_at)
+                            if vs.start_date == start_date)
+
+    return sorted(observations, key=lambda vs: vs.observed_at)
+
+
+class Replay:
+    def __init__(self, predictor, observations, step=STEP, speedup=None):
+        self.predictor = predictor
+        self.observations = observations
+        self.step = datetime.timedelta(seconds=step)
+        self.speedup = speedup
+        self.timeline = {}
+        self.ticks = 0
+
+    @property
+    def service_window(self):
+        # Cover the whole service day, including trips running past midnight
+        trips = self.predictor.active_trips
+        if not trips:
+            return self.predictor.service_date, self.predictor.service_date
+
+        first = min(trip.first_departure for trip in trips)
+        last = max(trip.last_arrival for trip in trips) + MISSING_THRESHOLD
+        return (self.predictor.service_date + datetime.timedelta(seconds=first) - self.step,
+                self.predictor.service_date + datetime.timedelta(seconds=last) + self.step)
+
+    def run(self, start=None, end=None):
+        window_start, window_end = self.service_window
+        start = start or window_start
+        end = end or window_end
+
+        predictor = self.predictor
+        trips = {trip.trip_id: trip for trip in predictor.active_trips}
+
+        # Only trips with new observations or a status threshold in the tick, and
+        # whatever follows them in their block, are predicted again
+        wakeups = []
+        for trip in trips.values():
+            for at in TripPredictor(trip, predictor.service_date, None, False).status_changes_at():
+                heapq.heappush(wakeups, (at, trip.trip_id))
+
+        trip_observations = {}
+        pending = 0
+        wall_start = time.monotonic()
+        now = start
+        while now <= end:
+            cutoff = now.timestamp()
+            changed_trips = set()
+            while pending < len(self.observations) and self.observations[pending].observed_at <= cutoff:
+                event = self.observations[pending]
+                trip_observations.setdefault(event.trip_id, {})[event.stop_sequence] = event
+                if event.trip_id in trips:
+                    changed_trips.add(event.trip_id)
+                pending += 1
+
+            for trip_id in changed_trips:
+                latest_event = max(trip_observations[trip_id].values(), key=lambda event: event.stop_sequence)
+                for at in TripPredictor(trips[trip_id], predictor.service_date, latest_event, False).status_changes_at():
+                    heapq.heappush(wakeups, (at, trip_id))
+
+            while wakeups and wakeups[0][0] <= now:
+                changed_trips.add(heapq.heappop(wakeups)[1])
+
+            if self.ticks == 0:
+                predictor.predict(trip_observations, now)
+                self.record_initial(now)
+            elif changed_trips:
+                predictor.update_trips(changed_trips, trip_observations, now)
+                self.record()
+
+            self.ticks += 1
+
+            now += self.step
+            if self.speedup:
+                deadline = wall_start + (now - start).total_seconds() / self.speedup
+                time.sleep(max(0, deadline - time.monotonic()))
+
+    def record_initial(self, now):
+        for trip_id, result in self.predictor.results.items():
+            self.timeline[trip_id] = [dict(
+                at=now.strftime('%Y-%m-%d %H:%M:%S'),
+                live_status=result['live_status'],
+                block_status=result['block_status'],
+            )]
+
+    def record(self):
+        for transition in self.predictor.transitions:
+            self.timeline.setdefault(transition['trip_id'], []).append(dict(
+                at=transition['at'],
+                live_status=transition['live_status'],
+                block_status=transition['block_status'],
+            ))
+
+
+if __name__ == '__main__':
+    main()
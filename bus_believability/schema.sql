@@ -11,7 +11,7 @@ CREATE TABLE IF NOT EXISTS vehicle_updates (
 	vehicle_id text, 
 	vehicle_status int, 
 	observed_at int, 
-	unique(start_date, trip_id, stop_sequence)
+	unique(start_date, trip_id, stop_sequence, lat, lon)
 );
 
 CREATE TABLE IF NOT EXISTS alerts (
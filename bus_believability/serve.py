@@ -0,0 +1,244 @@
+#!/usr/bin/env pypy3
+import argparse
+import collections
+import datetime
+import itertools
+import json
+import threading
+import time
+from dataclasses import dataclass
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from pathlib import Path
+from .predict import Predictor
+from .operators import VICTORIA, load_operators
+
+REFRESH = 20 # Same cadence as the vehicle tracker
+ALERTS_REFRESH = 1800 # Same cadence as the alerts tracker
+REPLAY_BUFFER = 10000
+KEEPALIVE = 15
+
+
+def main():
+    cmd = argparse.ArgumentParser(description='Serve predictions and stream status transitions over Server-Sent Events')
+    cmd.add_argument('--gtfs', help='Directory containing GTFS static feed (with --config, one partition per operator)', required=True)
+    cmd.add_argument('--db-dir', help='Directory the vehicle tracker writes day databases to (its --dir)', type=Path, required=True)
+    cmd.add_argument('--alerts', help='A SQLite database containing BCTransit-proprietary alerts', type=Path)
+    cmd.add_argument('--alerts-dir', help='With --config, the directory the alerts tracker writes to (its --dir)', type=Path)
+    cmd.add_argument('--config', help='JSON file listing operators to serve')
+    cmd.add_argument('--host', default='0.0.0.0')
+    cmd.add_argument('--port', type=int, default=8000)
+    cmd.add_argument('--buffer', help='Number of events kept for clients resuming with Last-Event-ID',
+                     type=int, default=REPLAY_BUFFER)
+    args = cmd.parse_args()
+    if args.config and not args.alerts_dir:
+        cmd.error('--alerts-dir is required with --config')
+    elif not args.config and not args.alerts:
+        cmd.error('--alerts is required without --config')
+
+    if args.config:
+        feeds = load_feeds(load_operators(args.config), Path(args.gtfs), args.db_dir, args.alerts_dir)
+        if not feeds:
+            cmd.error('none of the operators could be loaded')
+    else:
+        feeds = {VICTORIA.name: Feed(Predictor(args.gtfs, None, args.alerts, service_day()), args.db_dir)}
+
+    service = PredictionService(feeds, ChangeLog(args.buffer))
+    threading.Thread(target=service.run, daemon=True).start()
+
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(service))
+    server.daemon_threads = True
+    print(f'Serving {", ".join(feeds)} on {args.host}:{args.port}')
+    server.serve_forever()
+
+
+def load_feeds(operators, gtfs_dir, db_dir, alerts_dir):
+    feeds = {}
+    for operator in operators:
+        # Like failed updates, an operator that can't be loaded (say its GTFS is missing)
+        # is logged and left out, rather than taking down every other operator
+        try:
+            predictor = Predictor(gtfs_dir / operator.prefix, None,
+                                  alerts_dir / operator.prefix / 'alerts.db' if operator.alert_url else None,
+                                  service_day())
+        except Exception as exc:
+            print(f'{operator.name}: not serving, failed to load: {exc}')
+            continue
+
+        feeds[operator.name] = Feed(predictor, db_dir / operator.prefix)
+
+    return feeds
+
+
+def service_day():
+    return datetime.datetime.combine(datetime.date.today(), datetime.time.min)
+
+
+def parse_event_id(value):
+    # None means the client's position is unknown, so it has to refetch /blocks
+    try:
+        return int(value)
+    except ValueError:
+        return None
+
+
+class ChangeLog:
+    # Bounded history of events, so clients can resume after a disconnect
+    def __init__(self, maxlen=REPLAY_BUFFER):
+        self.events = collections.deque(maxlen=maxlen)
+        # Start from the clock, so IDs from a previous process never look current
+        self.last_id = int(time.time()) * 1000
+        self.cond = threading.Condition()
+
+    def append(self, event, data):
+        self.extend(event, [data])
+
+    def extend(self, event, items):
+        with self.cond:
+            for data in items:
+                self.last_id += 1
+                self.events.append((self.last_id, event, data))
+
+            self.cond.notify_all()
+
+    def since(self, last_id, timeout=None):
+        # None means the client can't be caught up and has to refetch /blocks
+        with self.cond:
+            if last_id == self.last_id:
+                self.cond.wait(timeout)
+
+            if last_id > self.last_id:
+                return None
+
+            first_id = self.events[0][0] if self.events else self.last_id + 1
+            if last_id < first_id - 1:
+                return None
+
+            return list(itertools.islice(self.events, last_id - first_id + 1, None))
+
+
+@dataclass
+class Feed:
+    predictor: Predictor
+    db_dir: Path
+    alerts_loaded_at: float = 0
+
+
+class PredictionService:
+    def __init__(self, feeds, changes):
+        self.feeds = feeds
+        self.changes = changes
+        self.lock = threading.Lock()
+
+    def run(self):
+        print('Started @', datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+        while True:
+            started = time.monotonic()
+            for name, feed in self.feeds.items():
+                # One operator's missing database or bad alert shouldn't hold up the others
+                try:
+                    self.update(name, feed)
+                except Exception as exc:
+                    print(f'{name}: {exc}')
+
+            time.sleep(max(0, REFRESH - (time.monotonic() - started)))
+
+    def update(self, name, feed):
+        today = service_day()
+        predictor = feed.predictor
+        with self.lock:
+            # The tracker rotates its database at midnight, so follow it
+            if predictor.con is None or predictor.service_date != today:
+                predictor.set_service_date(today)
+                predictor.connect(feed.db_dir / f"{today.strftime('%Y%m%d')}.db")
+                feed.alerts_loaded_at = time.monotonic()
+            elif time.monotonic() - feed.alerts_loaded_at >= ALERTS_REFRESH:
+                predictor.reload_alerts()
+                feed.alerts_loaded_at = time.monotonic()
+
+            seeding = not predictor.results
+            predictor.update()
+            if seeding:
+                # Every trip is new, so tell clients to refetch /blocks rather than sending each one
+                self.changes.append('reset', dict(operator=name))
+            else:
+                self.changes.extend('transition', [dict(transition, operator=name)
+                                                   for transition in predictor.transitions])
+
+        print(f'{name}: published {"a reset" if seeding else f"{len(predictor.transitions)} transitions"}')
+
+    def snapshot(self, names):
+        with self.lock:
+            return dict(
+                last_event_id=self.changes.last_id,
+                operators={name: self.operator_snapshot(self.feeds[name].predictor) for name in names},
+            )
+
+    def operator_snapshot(self, predictor):
+        return dict(
+            service_date=predictor.service_date.strftime('%Y%m%d'),
+            # Empty until the first update for the date has finished
+            blocks=predictor.get_all_blocks() if predictor.results else {},
+        )
+
+
+def make_handler(service):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlparse(self.path)
+            query = parse_qs(url.query)
+            names = query.get('operator') or list(service.feeds)
+            if any(name not in service.feeds for name in names):
+                self.send_error(404, 'Unknown operator')
+            elif url.path == '/blocks':
+                self.send_blocks(names)
+            elif url.path == '/events':
+                self.send_events(query, set(names))
+            else:
+                self.send_error(404)
+
+        def send_blocks(self, names):
+            body = json.dumps(service.snapshot(names)).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def send_events(self, query, names):
+            last_id = self.headers.get('Last-Event-ID') or query.get('last_event_id', [None])[0]
+            last_id = parse_event_id(last_id) if last_id else service.changes.last_id
+
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Cache-Control', 'no-cache')
+            self.end_headers()
+
+            try:
+                while True:
+                    events = service.changes.since(last_id, KEEPALIVE) if last_id is not None else None
+                    if events is None:
+                        last_id = service.changes.last_id
+                        self.send_event(last_id, 'reset', {})
+                    elif not events:
+                        self.wfile.write(b': keepalive\n\n')
+                    else:
+                        for event_id, event, data in events:
+                            if data['operator'] in names:
+                                self.send_event(event_id, event, data)
+                        last_id = events[-1][0]
+
+                    self.wfile.flush()
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+
+        def send_event(self, event_id, event, data):
+            # Transitions are the default event type, which EventSource delivers to onmessage
+            event_line = f'event: {event}\n' if event != 'transition' else ''
+            self.wfile.write(f'id: {event_id}\n{event_line}data: {json.dumps(data)}\n\n'.encode())
+
+    return Handler
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+#!/usr/bin/env pypy3
+import os
+import argparse
+import datetime
+import time
+import multiprocessing
+from functools import cached_property
+from .predict import Predictor
+
+
+def _serve_shard(predictor, conn, block_ids):
+    # Runs in a forked worker, which inherits the GTFS structures copy-on-write and
+    # keeps its shard's last results, so only what changed is pickled back
+    results = {}
+    while (job := conn.recv()) is not None:
+        trip_observations, now = job
+        shard_results = predictor.predict_blocks(block_ids, trip_observations, now)
+        conn.send({trip_id: result for trip_id, result in shard_results.items()
+                   if results.get(trip_id) != result})
+        results = shard_results
+
+
+class ShardedPredictor(Predictor):
+    def __init__(self, gtfs_path, db_path, alerts_db_path, service_date, workers=None):
+        super().__init__(gtfs_path, db_path, alerts_db_path, service_date)
+        self.workers = workers or os.cpu_count()
+
+    @cached_property
+    def shards(self):
+        # Blocks are independent, so balance them across workers by number of trips
+        shards = [[] for _ in range(self.workers)]
+        sizes = [0] * self.workers
+        for block_id, trips in sorted(self.trips_by_block.items(), key=lambda item: -len(item[1])):
+            smallest = sizes.index(min(sizes))
+            shards[smallest].append(block_id)
+            sizes[smallest] += len(trips)
+
+        return [shard for shard in shards if shard]
+
+    @cached_property
+    def shard_trip_ids(self):
+        return [[trip.trip_id for block_id in shard for trip in self.trips_by_block[block_id]]
+                for shard in self.shards]
+
+    @cached_property
+    def shard_workers(self):
+        # Workers mustn't share the parent's SQLite connection, so don't let them inherit it
+        db_path = self.db_path if self.con else None
+        if self.con:
+            self.con.close()
+            self.con = None
+
+        context = multiprocessing.get_context('fork')
+        shard_workers = []
+        for shard in self.shards:
+            conn, worker_conn = context.Pipe()
+            process = context.Process(target=_serve_shard, args=(self, worker_conn, shard), daemon=True)
+            process.start()
+            worker_conn.close()
+            shard_workers.append((process, conn))
+
+        if db_path:
+            self.connect(db_path)
+
+        return shard_workers
+
+    def predict(self, trip_observations, now):
+        # Only the latest event of each trip matters, so that's all that gets pickled
+        for (process, conn), trip_ids in zip(self.shard_workers, self.shard_trip_ids):
+            shard_observations = {}
+            for trip_id in trip_ids:
+                if observations := trip_observations.get(trip_id):
+                    latest_event = max(observations.values(), key=lambda event: event.stop_sequence)
+                    shard_observations[trip_id] = {latest_event.stop_sequence: latest_event}
+
+            conn.send((shard_observations, now))
+
+        changed = {}
+        for process, conn in self.shard_workers:
+            changed.update(conn.recv())
+
+        # Same ordering as the serial path
+        self.set_results({trip.trip_id: changed.get(trip.trip_id) or self.results[trip.trip_id]
+                          for trips in self.trips_by_block.values() for trip in trips}, now)
+
+    def set_service_date(self, service_date):
+        # Workers hold the old date's schedule, so they have to be forked again
+        self.stop_workers()
+        super().set_service_date(service_date)
+        for name in ('shards', 'shard_trip_ids'):
+            self.__dict__.pop(name, None)
+
+    def reload_alerts(self):
+        # Workers hold the cancellations from when they were forked, so fork them again
+        self.stop_workers()
+        super().reload_alerts()
+
+    def stop_workers(self):
+        for process, conn in self.__dict__.pop('shard_workers', []):
+            conn.send(None)
+            conn.close()
+            process.join()
+
+    def close(self):
+        self.stop_workers()
+        super().close()
+
+
+def main():
+    # Compares serial and sharded prediction on the same feed and observations
+    cmd = argparse.ArgumentParser(description='Benchmark prediction across numbers of worker processes')
+    cmd.add_argument('--gtfs', help='Directory containing GTFS static feed', required=True)
+    cmd.add_argument('--db', help='A SQLite database containing GTFS-RT observations', required=True)
+    cmd.add_argument('--alerts', help='A SQLite database containing BCTransit-proprietary alerts', required=True)
+    cmd.add_argument('--date', help='Service date in yyyymmdd format', required=True)
+    cmd.add_argument('--workers', help='Numbers of processes to compare (1 is the serial predictor)',
+                     type=int, nargs='+', default=[1, 2, 4])
+    cmd.add_argument('--updates', help='Updates to time for each number of workers', type=int, default=10)
+    args = cmd.parse_args()
+
+    service_date = datetime.datetime.strptime(args.date, '%Y%m%d')
+    print(f'{os.cpu_count()} CPUs, {args.updates} updates each')
+    predictor = Predictor(args.gtfs, args.db, args.alerts, service_date)
+    trip_observations = predictor.fetch_observations()
+    end = service_date + datetime.timedelta(days=1)
+
+    serial_time = None
+    for workers in args.workers:
+        if workers > 1:
+            predictor = ShardedPredictor(args.gtfs, args.db, args.alerts, service_date, workers=workers)
+
+        # The first update forks the workers and has nothing to diff against, so time it separately
+        started = time.perf_counter()
+        predictor.predict(trip_observations, service_date)
+        first_time = time.perf_counter() - started
+
+        # Sweep the day, so statuses change between updates like they would live
+        started = time.perf_counter()
+        for i in range(args.updates):
+            predictor.predict(trip_observations, service_date + (end - service_date) * (i + 1) / args.updates)
+        update_time = (time.perf_counter() - started) / args.updates
+        predictor.close()
+
+        serial_time = serial_time or update_time
+        print(f'{workers:3d} workers: first update {first_time * 1000:7.1f} ms, '
+              f'then {update_time * 1000:7.1f} ms per update ({serial_time / update_time:.2f}x)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,204 @@
+#!/usr/bin/env pypy3
+import argparse
+import contextlib
+import datetime
+import json
+import math
+import resource
+import sqlite3
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+import requests
+from .schema import apply_schema
+from .operators import Operator
+from .mock_feed import MockFeed, VEHICLES_PATH, ALERTS_PATH, add_fault_arguments, faults_from_args
+from .track import vehicles, alerts
+
+
+def main():
+    cmd = argparse.ArgumentParser(description='Soak test the trackers against a local mock feed')
+    cmd.add_argument('--hours', help='Hours of simulated time to run for', type=float, default=1)
+    cmd.add_argument('--speedup', help='Simulated seconds per wall clock second', type=float, default=1)
+    cmd.add_argument('--start', help='Simulated start time, e.g. 2024-01-01T23:30 to soak across a rotation (default: now)',
+                     type=datetime.datetime.fromisoformat)
+    cmd.add_argument('--operators', help='Operators to track, all polling the mock feed', type=int, default=1)
+    cmd.add_argument('--report-every', help='Simulated minutes between report lines', type=float, default=15)
+    cmd.add_argument('--dir', help='Directory for the databases and archive (default: a temporary directory)', type=Path)
+    cmd.add_argument('--output', help='Write every sample as JSON to this file', type=Path)
+    add_fault_arguments(cmd)
+    args = cmd.parse_args()
+
+    feed = MockFeed(args.vehicles, faults_from_args(args), args.seed)
+    server = feed.serve('127.0.0.1', 0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f'http://127.0.0.1:{server.server_address[1]}'
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        soak = Soak(feed, base_url, args.dir or Path(tmp_dir), args.speedup,
+                    args.operators, args.start or datetime.datetime.now())
+        soak.run(args.hours * 3600, args.report_every * 60)
+
+    server.shutdown()
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(soak.samples, fp, indent=2)
+
+
+def rss_mib():
+    # Current RSS where /proc is available, otherwise the peak
+    try:
+        with open('/proc/self/statm') as fp:
+            return int(fp.read().split()[1]) * resource.getpagesize() / 2**20
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def percentile(values, q):
+    if len(values) < 2:
+        return values[0] if values else 0
+    return statistics.quantiles(values, n=100, method='inclusive')[q - 1]
+
+
+class Soak:
+    # Runs the vehicle tracker's own loop, rotation and archiving on a compressed clock.
+    # Only the sleep between polls is compressed: processing and injected latency take
+    # real time, so they're reported in wall seconds against the tracker's real 20 s cadence.
+    def __init__(self, feed, base_url, soak_dir, speedup, n_operators, start):
+        self.feed = feed
+        self.alerts_url = base_url + ALERTS_PATH
+        self.db_dir = soak_dir / 'db'
+        self.bucket_dir = soak_dir / 'bucket'
+        self.alerts_db_file = soak_dir / 'soak-alerts.db'
+        self.log_file = soak_dir / 'tracker.log'
+        self.speedup = speedup
+        self.start = start
+        self.wall_start = time.monotonic()
+        self.samples = []
+        self.alert_errors = 0
+        self.report_to = sys.stdout
+
+        self.trackers = []
+        for i in range(n_operators):
+            operator = Operator(operator_id=str(i), name=f'soak{i}')
+            self.bucket_dir.joinpath(operator.prefix).mkdir(parents=True, exist_ok=True)
+            db_rotator = vehicles.DBRotator(self.db_dir / operator.prefix, f'{self.bucket_dir / operator.prefix}/',
+                                            today=self.today)
+            self.trackers.append(vehicles.OperatorTracker(operator, db_rotator, url=base_url + VEHICLES_PATH))
+
+    def now(self):
+        return self.start + datetime.timedelta(seconds=(time.monotonic() - self.wall_start) * self.speedup)
+
+    def today(self):
+        return self.now().date()
+
+    def run(self, duration, report_every):
+        self.report_every = report_every
+        self.next_report = report_every
+        cycles = math.ceil(duration / vehicles.REFRESH)
+
+        print(f'Soaking {len(self.trackers)} operators for {duration / 3600:.1f} simulated hours from {self.start}, '
+              f'one poll every {vehicles.REFRESH / self.speedup:.2f}s; tracker output in {self.log_file}')
+        print(f'busy, late and lag are wall seconds; each poll has a {vehicles.REFRESH}s budget')
+        print('sim time  polls  errors  busy p50/p95/max (s)  late p50/p95/max (s)  lag p50/p95/max (s)  vehicles  db MiB  rss MiB')
+
+        done = threading.Event()
+        alert_thread = threading.Thread(target=self.poll_alerts, args=(done,), daemon=True)
+        self.wall_start = time.monotonic()
+        alert_thread.start()
+        # The tracker reports every poll, which would bury the soak report
+        with open(self.log_file, 'w') as log, contextlib.redirect_stdout(log):
+            vehicles.loop_operators(self.trackers, vehicles.REFRESH / self.speedup, cycles, self.sample)
+            done.set()
+            alert_thread.join()
+
+            # Let rotations that just happened finish compacting and archiving
+            for tracker in self.trackers:
+                if tracker.db_rotator.archiver:
+                    tracker.db_rotator.archiver.join()
+
+        self.report(self.samples, final=True)
+
+    def poll_alerts(self, done):
+        sess = requests.Session()
+        con = sqlite3.connect(self.alerts_db_file)
+        apply_schema(con)
+        while not done.is_set():
+            try:
+                alerts.process_alerts(sess, con, self.alerts_url)
+            except Exception as exc:
+                print(f'Alerts: {exc}')
+                self.alert_errors += 1
+            done.wait(alerts.REFRESH / self.speedup)
+
+        con.close()
+
+    def sample(self, started, elapsed, n_vehicles):
+        # busy is what the poll would take out of its 20 s live; late is how far the compressed
+        # loop started behind its own cadence
+        previous = self.samples[-1]['started'] if self.samples else None
+        sample = dict(
+            started=started,
+            sim_time=(started - self.wall_start) * self.speedup,
+            busy=elapsed,
+            late=started - previous - vehicles.REFRESH / self.speedup if previous else 0,
+            lag=time.monotonic() - self.feed.generated_at if self.feed.generated_at else None,
+            vehicles=n_vehicles,
+            errors=[f'{type(tracker.last_error).__name__}: {tracker.last_error}'
+                    for tracker in self.trackers if tracker.last_error],
+            db_bytes=sum(path.stat().st_size for path in self.db_dir.rglob('*.db')),
+            rss_mib=rss_mib(),
+        )
+        self.samples.append(sample)
+
+        if sample['sim_time'] >= self.next_report:
+            self.report(self.samples[-int(self.report_every // vehicles.REFRESH):])
+            self.next_report += self.report_every
+
+    def report(self, samples, final=False):
+        if not samples:
+            return
+
+        busy = [sample['busy'] for sample in samples]
+        late = [sample['late'] for sample in samples]
+        lag = [sample['lag'] for sample in samples if sample['lag'] is not None]
+        errors = sum(len(sample['errors']) for sample in samples)
+        last = samples[-1]
+        n_vehicles = max(sample['vehicles'] for sample in samples)
+        label = 'total' if final else f"{last['sim_time'] / 3600:5.2f}h"
+
+        print(f"{label:>8}  {len(samples):5d}  {errors:6d}  "
+              f"{percentile(busy, 50):6.2f}/{percentile(busy, 95):6.2f}/{max(busy):6.2f}  "
+              f"{percentile(late, 50):6.2f}/{percentile(late, 95):6.2f}/{max(late):6.2f}  "
+              f"{percentile(lag, 50) if lag else 0:6.2f}/{percentile(lag, 95) if lag else 0:6.2f}/{max(lag, default=0):6.2f}  "
+              f"{n_vehicles:8d}  {last['db_bytes'] / 2**20:6.1f}  {last['rss_mib']:7.1f}", file=self.report_to)
+
+        if final:
+            over = sum(sample['busy'] > vehicles.REFRESH for sample in samples)
+            print(f'{over} of {len(samples)} polls took longer than the {vehicles.REFRESH}s budget', file=self.report_to)
+            behind = sum(sample['late'] > vehicles.REFRESH / self.speedup for sample in samples)
+            if behind:
+                # The simulated clock follows wall time, so it ran ahead of the polls
+                print(f'{behind} polls fell more than a compressed interval behind; '
+                      f'lower --speedup to keep simulated time and polls in step', file=self.report_to)
+            error_kinds = {}
+            for sample in samples:
+                for error in sample['errors']:
+                    kind = error.split(':')[0]
+                    error_kinds[kind] = error_kinds.get(kind, 0) + 1
+            for kind, count in sorted(error_kinds.items()):
+                print(f'  {count} x {kind}', file=self.report_to)
+            if self.alert_errors:
+                print(f'  {self.alert_errors} failed alert polls', file=self.report_to)
+
+            day_files = sorted(path.relative_to(self.db_dir) for path in self.db_dir.rglob('*.db'))
+            archived = sorted(path.relative_to(self.bucket_dir) for path in self.bucket_dir.rglob('*.db'))
+            print(f'Day databases: {", ".join(map(str, day_files))}; archived: {", ".join(map(str, archived)) or "none"}',
+                  file=self.report_to)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,167 @@
+#!/usr/bin/env pypy3
+import sys
+import time
+import importlib
+import importlib.abc
+import contextlib
+import os
+
+# Python's -X importtime isn't available under PyPy, so time imports with a
+# meta path hook instead, which works under both
+STARTED = time.perf_counter()
+
+ENTRY_POINTS = {
+    'predict': 'bus_believability.predict',
+    'vehicles': 'bus_believability.track.vehicles',
+}
+
+# Functions whose time counts as initialization, per entry point
+PHASES = {
+    'predict': [
+        ('gtfs_loader', 'load'),
+        ('bus_believability.aggregate', 'get_itineraries'),
+        ('bus_believability.aggregate', 'get_stop_index'),
+        ('bus_believability.aggregate', 'ServiceIndex'),
+        ('bus_believability.alerts', 'recognize_alerts'),
+        ('bus_believability.alerts', 'link_alerts'),
+        ('bus_believability.predict', 'Predictor.fetch_observations'),
+        ('bus_believability.predict', 'Predictor.predict'),
+    ],
+    'vehicles': [
+        ('bus_believability.track.vehicles', 'sync_data'),
+        ('bus_believability.track.vehicles', 'DBRotator.connect'),
+        ('bus_believability.track.vehicles', 'update_vehicle_positions'),
+    ],
+}
+
+# The tracker never exits, so stop once it has stored its first poll
+STOP_AFTER = {
+    'vehicles': ('bus_believability.track.vehicles', 'update_vehicle_positions'),
+}
+
+
+class StartupComplete(BaseException):
+    # Not an Exception, so the tracker's error handling doesn't swallow it
+    pass
+
+
+class ImportTimer(importlib.abc.MetaPathFinder):
+    def __init__(self, on_import=None):
+        self.stack = []
+        self.times = {} # module -> [cumulative, self]
+        self.on_import = on_import
+
+    def find_spec(self, name, path, target=None):
+        for finder in sys.meta_path:
+            if finder is self:
+                continue
+            spec = finder.find_spec(name, path, target) if hasattr(finder, 'find_spec') else None
+            if spec and spec.loader and hasattr(spec.loader, 'exec_module'):
+                spec.loader = TimedLoader(self, spec.loader)
+                return spec
+            if spec:
+                return spec
+
+        return None
+
+    def timed_exec(self, name, exec_module, module):
+        started = time.perf_counter()
+        self.stack.append(0)
+        try:
+            exec_module(module)
+        finally:
+            elapsed = time.perf_counter() - started
+            children = self.stack.pop()
+            if self.stack:
+                self.stack[-1] += elapsed
+            self.times[name] = [elapsed, elapsed - children]
+
+        if self.on_import:
+            self.on_import(module)
+
+
+class TimedLoader(importlib.abc.Loader):
+    def __init__(self, timer, loader):
+        self.timer = timer
+        self.loader = loader
+
+    def create_module(self, spec):
+        return self.loader.create_module(spec)
+
+    def exec_module(self, module):
+        self.timer.timed_exec(module.__name__, self.loader.exec_module, module)
+
+    def __getattr__(self, name):
+        return getattr(self.loader, name)
+
+
+def wrap_phases(entry_point, module, phase_times):
+    # Called as each module finishes importing, so the profiler never imports anything
+    # earlier than the entry point would, and the import cost stays where it belongs
+    for module_name, qualname in PHASES[entry_point]:
+        if module_name != module.__name__:
+            continue
+
+        owner = module
+        *parents, attr = qualname.split('.')
+        for parent in parents:
+            owner = getattr(owner, parent)
+
+        stop = STOP_AFTER.get(entry_point) == (module_name, qualname)
+        setattr(owner, attr, timed(getattr(owner, attr), f'{module_name}.{qualname}', phase_times, stop))
+
+
+def timed(fn, label, phase_times, stop=False):
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            phase_times[label] = phase_times.get(label, 0) + time.perf_counter() - started
+            if stop:
+                raise StartupComplete()
+
+    return wrapper
+
+
+def main():
+    if len(sys.argv) < 2 or sys.argv[1] not in ENTRY_POINTS:
+        print(f'Usage: {sys.argv[0]} {{{",".join(ENTRY_POINTS)}}} [entry point arguments...]')
+        print('Breaks down import and initialization time for an entry point')
+        sys.exit(1)
+
+    entry_point = sys.argv[1]
+    phase_times = {}
+    timer = ImportTimer(lambda module: wrap_phases(entry_point, module, phase_times))
+    sys.meta_path.insert(0, timer)
+
+    import_started = time.perf_counter()
+    module = importlib.import_module(ENTRY_POINTS[entry_point])
+    import_time = time.perf_counter() - import_started
+
+    sys.argv = [ENTRY_POINTS[entry_point]] + sys.argv[2:]
+    run_started = time.perf_counter()
+    # Entry points print their results, which would bury the report
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        try:
+            module.main()
+        except StartupComplete:
+            pass
+    run_time = time.perf_counter() - run_started
+
+    print(f'{sys.implementation.name} {sys.version.split()[0]}, entry point {entry_point}')
+    print(f'Imported {ENTRY_POINTS[entry_point]} in {import_time * 1000:.1f} ms')
+    print(f'  {"cumulative":>10}  {"self":>8}  module')
+    slowest = sorted(timer.times.items(), key=lambda item: -item[1][0])[:25]
+    for name, (cumulative, own) in slowest:
+        print(f'  {cumulative * 1000:8.1f}ms  {own * 1000:6.1f}ms  {name}')
+
+    print(f'Ran in {run_time * 1000:.1f} ms')
+    for label, elapsed in sorted(phase_times.items(), key=lambda item: -item[1]):
+        print(f'  {elapsed * 1000:8.1f}ms  {label}')
+
+    print(f'Total {(time.perf_counter() - STARTED) * 1000:.1f} ms since the profiler started')
+
+
+if __name__ == '__main__':
+    main()
@@ -3,18 +3,31 @@ import datetime
 import time
 import sqlite3
 import argparse
+from pathlib import Path
 from ..schema import Alert, apply_schema
+from ..operators import VICTORIA, load_operators
 
 
-ALERT_URL = 'https://www.bctransit.com/sites/REST/controller/ServiceAlert/get-alert-list?micrositeid=1520526315921&timezone=Canada/Pacific'
+ALERT_URL = VICTORIA.alert_url
 REFRESH = 1800
 
 
 def main():
     cmd = argparse.ArgumentParser()
     cmd.add_argument('--db', help='Location of the alets database')
+    cmd.add_argument('--dir', help='Directory to write one alerts database per operator (with --config)', type=Path)
+    cmd.add_argument('--config', help='JSON file listing operators to track')
     args = cmd.parse_args()
-    track_alerts(args.db)
+    if args.config and not args.dir:
+        cmd.error('--dir is required with --config')
+    elif not args.config and not args.db:
+        cmd.error('--db is required without --config')
+
+    if args.config:
+        operators = [operator for operator in load_operators(args.config) if operator.alert_url]
+        track_operator_alerts(operators, args.dir)
+    else:
+        track_alerts(args.db)
 
 
 def track_alerts(db_file):
@@ -30,14 +43,34 @@ def track_alerts(db_file):
     
         time.sleep(REFRESH)
 
-def fetch_alerts(sess):
-    res = sess.get(ALERT_URL)
+
+def track_operator_alerts(operators, db_dir):
+    sess = requests.Session()
+    cons = {}
+    for operator in operators:
+        (db_dir / operator.prefix).mkdir(parents=True, exist_ok=True)
+        cons[operator.name] = sqlite3.connect(db_dir / operator.prefix / 'alerts.db')
+        apply_schema(cons[operator.name])
+
+    # Alerts change slowly, so polling operators one after another is plenty
+    while True:
+        for operator in operators:
+            try:
+                process_alerts(sess, cons[operator.name], operator.alert_url)
+            except Exception as exc:
+                print(f'{operator.name}: {exc}')
+
+        time.sleep(REFRESH)
+
+
+def fetch_alerts(sess, url=ALERT_URL):
+    res = sess.get(url)
     return res.json()
 
 
-def process_alerts(sess, con):
+def process_alerts(sess, con, url=ALERT_URL):
     cur = con.cursor()
-    raw_alerts = fetch_alerts(sess)
+    raw_alerts = fetch_alerts(sess, url)
     alerts = []
     for raw_alert in raw_alerts:
         alerts.extend(parse_alert(raw_alert))
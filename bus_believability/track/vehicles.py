@@ -1,30 +1,35 @@
 #!/usr/bin/env pypy3
 from . import gtfs_realtime_pb2 as rt
+import re
 import time
 import datetime
 import sqlite3
 import requests
 import argparse
 import subprocess
-from dataclasses import dataclass
-from typing import Optional
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Optional, Callable
 from pathlib import Path
 from ..schema import VehicleState, apply_schema
+from ..compact import compact_db
+from ..operators import VICTORIA, Operator, load_operators
 
 
-VEHICLE_UPDATES_URL = 'https://bct.tmix.se/gtfs-realtime/vehicleupdates.pb?operatorIds=20'
+VEHICLE_UPDATES_URL = VICTORIA.vehicle_updates_url
 ROOT = Path(__file__).parent.parent
+REFRESH = 20
+MAX_WORKERS = 16
 
+# Operators rotate at the same time, so upload one at a time rather than all at once
+ARCHIVE_LOCK = threading.Lock()
 
-def update_vehicle_positions(sess, con, url=VEHICLE_UPDATES_URL):
-    res = sess.get(url)
-    cur = con.cursor()
-    vp = rt.FeedMessage()
-    vp.ParseFromString(res.content)
-    vehicles_observed = set()
+
+def parse_vehicle_positions(vp, observed_at):
     for entity in vp.entity:
         vehicle = entity.vehicle
-        vs = VehicleState(
+        yield VehicleState(
             start_date=int(
                 vehicle.trip.start_date) if vehicle.trip.start_date else None,
             trip_id=vehicle.trip.trip_id,
@@ -37,8 +42,17 @@ def update_vehicle_positions(sess, con, url=VEHICLE_UPDATES_URL):
             stop_id=vehicle.stop_id,
             vehicle_id=vehicle.vehicle.id,
             vehicle_status=vehicle.current_status,
-            observed_at=int(time.time())
+            observed_at=observed_at
         )
+
+
+def update_vehicle_positions(sess, con, url=VEHICLE_UPDATES_URL):
+    res = sess.get(url)
+    cur = con.cursor()
+    vp = rt.FeedMessage()
+    vp.ParseFromString(res.content)
+    vehicles_observed = set()
+    for vs in parse_vehicle_positions(vp, int(time.time())):
         vehicles_observed.add(vs.vehicle_id)
         cur.execute(f"""
         INSERT INTO vehicle_updates
@@ -51,22 +65,47 @@ def update_vehicle_positions(sess, con, url=VEHICLE_UPDATES_URL):
         """, vs.astuple())
         con.commit()
 
-    print(f'Updated {vehicles_observed}')
+    return vehicles_observed
 
 
 def main():
     cmd = argparse.ArgumentParser()
     cmd.add_argument(
-        '--dir', help='Directory to write database files', type=Path)
-    cmd.add_argument('--bucket', help='Bucket for archived database files')
+        '--dir', help='Directory to write database files', type=Path, required=True)
+    cmd.add_argument('--bucket', help='Bucket for archived database files', required=True)
+    cmd.add_argument(
+        '--config', help='JSON file listing operators to track, each in its partition of --dir and --bucket')
     args = cmd.parse_args()
-    db_rotator = DBRotator(args.dir, args.bucket)
-    loop(db_rotator)
 
+    if args.config:
+        trackers = [OperatorTracker(operator, DBRotator(args.dir / operator.prefix, args.bucket + operator.prefix))
+                    for operator in load_operators(args.config)]
+        loop_operators(trackers)
+    else:
+        db_rotator = DBRotator(args.dir, args.bucket)
+        loop(db_rotator)
 
-def sync_data(db_dir, bucket_url):
+
+def sync_data(db_dir, bucket_url, exclude=None):
+    # exclude is the live database, which would be uploaded half-written
+    exclude_args = ['-x', f'^{re.escape(exclude.name)}'] if exclude else []
     print('Archiving data...')
-    subprocess.run(['gsutil', '-m', 'rsync', db_dir, bucket_url])
+    subprocess.run(['gsutil', '-m', 'rsync', *exclude_args, db_dir, bucket_url])
+
+
+def archive_closed_db(db_dir, bucket_url, closed_file, live_file):
+    # closed_file is None on startup, when there's only catching up on archiving to do
+    if closed_file:
+        try:
+            compact_db(closed_file)
+        except Exception as exc:
+            print(f'Failed to compact {closed_file}: {exc}')
+
+    with ARCHIVE_LOCK:
+        try:
+            sync_data(db_dir, bucket_url, exclude=live_file)
+        except OSError as exc:
+            print(f'Failed to archive {db_dir}: {exc}')
 
 
 
@@ -78,19 +117,33 @@ class DBRotator:
     bucket_url: str
     date: Optional[datetime.date] = None
     con: Optional[sqlite3.Connection] = None
+    db_file: Optional[Path] = None
+    today: Callable[[], datetime.date] = datetime.date.today
+    archiver: Optional[threading.Thread] = None
 
     def connect(self):
-        now = datetime.date.today()
+        now = self.today()
         if self.date == now:
             return self.con
 
         print(f'Rotating database {self.date} -> {now}')
         self.date = now
 
-        sync_data(self.db_dir, self.bucket_url)
-        db_file = self.db_dir / f"{self.date.strftime('%Y%m%d')}.db"
-        self.con = sqlite3.connect(db_file)
+        closed_file = self.db_file if self.con else None
+        if self.con:
+            self.con.close()
+
+        self.db_dir.mkdir(parents=True, exist_ok=True)
+        self.db_file = self.db_dir / f"{self.date.strftime('%Y%m%d')}.db"
+        # Operators are polled from a thread pool, but never concurrently with themselves
+        self.con = sqlite3.connect(self.db_file, check_same_thread=False)
         apply_schema(self.con)
+
+        # Compacting and uploading take a while, and polling can't wait for them
+        self.archiver = threading.Thread(target=archive_closed_db, daemon=True,
+                                         args=(self.db_dir, self.bucket_url, closed_file, self.db_file))
+        self.archiver.start()
+
         return self.con
 
 
@@ -101,11 +154,53 @@ def loop(db_rotator):
     while True:
         try:
             con = db_rotator.connect()
-            update_vehicle_positions(sess, con)
+            vehicles_observed = update_vehicle_positions(sess, con)
+            print(f'Updated {vehicles_observed}')
         except Exception as exc:
             print(exc)
 
-        time.sleep(20)
+        time.sleep(REFRESH)
+
+
+@dataclass
+class OperatorTracker:
+    operator: Operator
+    db_rotator: DBRotator
+    sess: requests.Session = field(default_factory=requests.Session)
+    url: Optional[str] = None # Instead of the operator's feed, e.g. a mock one
+    last_error: Optional[Exception] = None
+
+    def poll(self):
+        try:
+            con = self.db_rotator.connect()
+            n_vehicles = len(update_vehicle_positions(self.sess, con, self.url or self.operator.vehicle_updates_url))
+            self.last_error = None
+            return n_vehicles
+        except Exception as exc:
+            print(f'{self.operator.name}: {exc}')
+            self.last_error = exc
+            return 0
+
+
+def loop_operators(trackers, refresh=REFRESH, cycles=None, on_cycle=None):
+    # cycles and on_cycle let the soak test drive this loop on a compressed clock
+    print('Started @', datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+          f'tracking {len(trackers)} operators')
+
+    # Each operator only holds a session and a connection, so memory stays flat per operator
+    with ThreadPoolExecutor(max_workers=min(len(trackers), MAX_WORKERS)) as pool:
+        cycle = 0
+        while cycles is None or cycle < cycles:
+            started = time.monotonic()
+            n_vehicles = sum(pool.map(OperatorTracker.poll, trackers))
+            elapsed = time.monotonic() - started
+            print(f'Updated {n_vehicles} vehicles across {len(trackers)} operators in {elapsed:.2f}s '
+                  f'({n_vehicles / elapsed:.0f} vehicles/s)')
+
+            if on_cycle:
+                on_cycle(started, elapsed, n_vehicles)
+            cycle += 1
+            time.sleep(max(0, refresh - elapsed))
 
 
 if __name__ == '__main__':
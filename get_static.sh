@@ -1,5 +1,14 @@
 #!/bin/sh
+# Usage: get_static.sh [operators.json]
+# With a config file, each operator's feed is unpacked into its partition of gtfs/
 
-curl -sSL https://bct.tmix.se/Tmix.Cap.TdExport.WebApi/gtfs/?operatorIds=20 -o gtfs.zip
-unzip -o -d gtfs gtfs.zip 
+if [ -z "$1" ]; then
+    curl -sSL https://bct.tmix.se/Tmix.Cap.TdExport.WebApi/gtfs/?operatorIds=20 -o gtfs.zip
+    unzip -o -d gtfs gtfs.zip 
+    exit
+fi
 
+${PYTHON:-pypy3} -m bus_believability.operators "$1" | while read name url prefix; do
+    curl -sSL "$url" -o "gtfs-$name.zip"
+    unzip -o -d "gtfs/$prefix" "gtfs-$name.zip"
+done